@@ -1,4 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
 import datasets
+import numpy as np
 from torch.utils.data import DataLoader
 from llama import Llama
 import torch
@@ -6,6 +8,7 @@ import fire
 from tqdm import tqdm
 
 import llamascope
+from activations_io import save_raw
 
 
 def main(
@@ -13,6 +16,9 @@ def main(
         tokenizer_path: str,
         max_seq_len: int = 256,
         max_batch_size: int = 16,
+        num_workers: int = 2,
+        bucket_batches: int = 8,
+        quantize: bool = True,
 ):
     # Load model
     print('--- Loading model ---')
@@ -23,27 +29,43 @@ def main(
         max_batch_size=max_batch_size,
     )
 
-    # Tokenisation
+    # Tokenisation (runs in dataloader workers, so only capture the tokenizer)
+    tokenizer = generator.tokenizer
+    pad_id = tokenizer.pad_id
+
+    # Texts this short are safe to pass to tiktoken in one piece; longer
+    # ones go through Tokenizer.encode, which splits them up first
+    max_batch_encode_chars = 25_000
+
     def tokenise_and_pad(x, seq_len=max_seq_len):
-        """Tokenise and pad/crop to seq_len tokens."""
-        # Tokenise the whole input
-        toks = generator.tokenizer.encode(x['text'], bos=True, eos=False)
-        toks = torch.tensor(toks, dtype=torch.long, device='cuda')
-
-        # Pad and crop to correct sequence length
-        if len(toks) == seq_len:
-            pass
-        
-        elif len(toks) > seq_len:
-            toks = toks[:seq_len]
-        
-        else:
-            pad_id = generator.tokenizer.pad_id
-            pad_toks = torch.full((seq_len,), pad_id).to(toks)
-            pad_toks[:len(toks)] = toks
-            toks = pad_toks
-        
-        return {'tokens': toks, 'text': x['text']}
+        """Tokenise a batch of texts, pad/crop to seq_len, and sort by length."""
+        # Tokenise the whole batch in one call to tiktoken's threaded batch
+        # encoder, cropping to the correct sequence length
+        texts = x['text']
+        short_ids = iter(tokenizer.model.encode_ordinary_batch(
+            [text for text in texts if len(text) < max_batch_encode_chars]
+            ))
+        ids_list = [
+            [tokenizer.bos_id] + next(short_ids)[:seq_len - 1]
+            if len(text) < max_batch_encode_chars
+            else tokenizer.encode(text, bos=True, eos=False)[:seq_len]
+            for text in texts
+        ]
+
+        # Pad into a single CPU buffer; moved to the GPU in the inference loop.
+        # Each element is written once: tokens first, then the padded tail.
+        toks = np.empty((len(ids_list), seq_len), dtype=np.int64)
+        for i, ids in enumerate(ids_list):
+            toks[i, :len(ids)] = ids
+            toks[i, len(ids):] = pad_id
+
+        # Sort so each dataloader batch holds texts of similar length and
+        # the inference loop can crop away most of the padding
+        order = np.argsort([len(ids) for ids in ids_list], kind='stable')
+        return {
+            'tokens': torch.from_numpy(toks[order]),
+            'text': [texts[j] for j in order],
+        }
 
     # Initialise streaming dataset
     print('\n--- Initialising streaming dataset ---')
@@ -52,36 +74,85 @@ def main(
         name="CC-MAIN-2024-10",
         split="train",
         streaming=True
-        ).map(tokenise_and_pad)
+        ).select_columns('text').map(
+            tokenise_and_pad,
+            batched=True,
+            batch_size=max_batch_size * bucket_batches,  # length-sorting window
+            )
     
-    # Build dataloader
-    dataloader = DataLoader(dataset, batch_size=max_batch_size)
+    # Build dataloader; pinned batches let the host-to-device copy run async
+    dataloader = DataLoader(
+        dataset,
+        batch_size=max_batch_size,
+        num_workers=num_workers,
+        pin_memory=True,
+        prefetch_factor=2 if num_workers > 0 else None,
+        persistent_workers=num_workers > 0,
+        )
 
     # Attach instrumentation
     scope = llamascope.LlamaScope(generator.model)
     location = 'layers-16'
-    scope.add_caching_hook(location)
-
-    # Inference loop
     write_every = int(1e2)
+    scope.add_caching_wrapper(
+        location,
+        num_slots=write_every,
+        slot_shape=(max_batch_size, max_seq_len, generator.model.params.dim),
+        quantize=quantize,
+        )
+
+    # Inference loop; files are written on a background thread
+    writer = ThreadPoolExecutor(max_workers=1)
+    pending_write = None
     num_written = 0
-    tokens_cache = []
+    tokens_slab = torch.empty(
+        (write_every, max_batch_size, max_seq_len), dtype=torch.long, device='cpu'
+        )
+    lengths_slab = torch.zeros(
+        (write_every, max_batch_size), dtype=torch.long, device='cpu'
+        )
     for i, data in tqdm(enumerate(dataloader)):
-        toks = data['tokens']
-        _ = generator.model(toks, start_pos=0)
-        tokens_cache.append(toks.cpu())
+        # Keep the host-side tokens; no device-to-host copy needed
+        tokens_slab[i % write_every, :len(data['tokens'])] = data['tokens']
+
+        # Crop to the longest text in the batch. Positions past a row's
+        # saved length hold zeros or stale activations and must be ignored.
+        lengths = (data['tokens'] != pad_id).sum(dim=1)
+        lengths_slab[i % write_every, :len(lengths)] = lengths
+        batch_len = int(lengths.max())
+        toks = data['tokens'].to('cuda', non_blocking=True)[:, :batch_len]
+        with torch.inference_mode(), torch.autocast('cuda', dtype=torch.bfloat16):
+            _ = generator.model(toks, start_pos=0)
 
         # Write activations and clear cache every write_every batches
-        if i % write_every == 0 and i > 0:
-            all_acts = torch.cat(scope.activations_cache[location])
-            all_toks = torch.cat(tokens_cache)
-            torch.save(
-                {'activations': all_acts, 'tokens': all_toks},
-                f'activations/{location}-{num_written}.pt'
-                 )
+        if (i + 1) % write_every == 0:
+            # Only one write in flight: wait for it before taking the next
+            # snapshot, so host memory holds at most one besides the slabs
+            if pending_write is not None:
+                pending_write.result()
+
+            scope.synchronize_caches()
+            all_acts = scope.activations_slab[location].flatten(0, 1).clone()
+            to_save = {
+                'tokens': tokens_slab.flatten(0, 1).clone(),
+                'lengths': lengths_slab.flatten(0, 1).clone(),  # valid positions
+            }
+            if quantize:  # activations ~= activations_q * scales[..., None]
+                to_save['activations_q'] = all_acts
+                to_save['scales'] = scope.scales_slab[location].flatten(0, 1).clone()
+            else:
+                to_save['activations'] = all_acts
+
+            pending_write = writer.submit(
+                save_raw, to_save, f'activations/{location}-{num_written}'
+                )
+            del all_acts, to_save  # the writer thread holds the only reference
             num_written += 1
             scope.clear_all_caches()
-            tokens_cache = []
+
+    writer.shutdown(wait=True)
+    if pending_write is not None:
+        pending_write.result()
 
 
 if __name__ == '__main__':
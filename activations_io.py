@@ -0,0 +1,52 @@
+import json
+
+import numpy as np
+import torch
+
+
+def save_raw(tensors, stem):
+    """Writes CPU tensors back to back to stem.bin, indexed by stem.json.
+
+    Skips torch.save's pickling, zip container and CRC pass; the index
+    records each tensor's dtype, shape and byte offset for load_raw.
+    """
+    index = {}
+    offset = 0
+    with open(f'{stem}.bin', 'wb') as f:
+        for name, tensor in tensors.items():
+            tensor = tensor.contiguous()
+            if tensor.dtype == torch.bfloat16:  # numpy has no bfloat16
+                array = tensor.view(torch.int16).numpy()
+            else:
+                array = tensor.numpy()
+
+            array.tofile(f)
+            index[name] = {
+                'dtype': str(tensor.dtype).removeprefix('torch.'),
+                'numpy_dtype': array.dtype.str,
+                'shape': list(tensor.shape),
+                'offset': offset,
+            }
+            offset += array.nbytes
+
+    with open(f'{stem}.json', 'w') as f:
+        json.dump(index, f)
+
+
+def load_raw(stem):
+    """Memory-maps the tensors written by save_raw(tensors, stem)."""
+    with open(f'{stem}.json') as f:
+        index = json.load(f)
+
+    tensors = {}
+    for name, entry in index.items():
+        array = np.memmap(
+            f'{stem}.bin',
+            dtype=entry['numpy_dtype'],
+            mode='c',  # copy-on-write, so torch gets a writable array
+            offset=entry['offset'],
+            shape=tuple(entry['shape']),
+            )
+        tensors[name] = torch.from_numpy(array).view(getattr(torch, entry['dtype']))
+
+    return tensors
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 import torch
 
+from quantization import quantize_rows
+
 
 class LlamaScope:
     """Class for adding, using, and removing PyTorch hooks with a model."""
@@ -9,21 +11,22 @@ class LlamaScope:
         self.model = model
         self.hooks = {}
         self.activations_cache = {}
+        self.activations_slab = {}
+        self.scales_cache = {}
+        self.scales_slab = {}
         self.override_store = {}
+        self._slab_idx = {}
+        self._copy_stream = None
         self._build_module_dict()
 
     """Module listing."""
     def _build_module_dict(self):
         """Walks the model's module tree and builds a name: module map."""
-        self._module_dict = {}
-
-        def recurse(module, prefix=''):
-            """Recursive tree walk to build self._module_dict."""
-            for name, child in module.named_children():
-                self._module_dict[prefix+name] = child
-                recurse(child, prefix=prefix+name+'-')
-
-        recurse(self.model)  # build the tree
+        self._module_dict = {
+            name.replace('.', '-'): module
+            for name, module in self.model.named_modules(remove_duplicate=False)
+            if name  # skip the root model itself
+        }
 
     def list_modules(self):
         """Lists all modules in the module dictionary."""
@@ -37,46 +40,206 @@ class LlamaScope:
         self.hooks[hook_name] = hook_handle
     
     """Activations caching"""
-    def _build_caching_hook(self, module_str):
-        self.activations_cache[module_str] = []
+    def _copy_to_host(self, dst, src):
+        """Copies src into the host tensor dst, asynchronously if src is CUDA."""
+        if not src.is_cuda:
+            dst.copy_(src)
+            return
+
+        if self._copy_stream is None:
+            self._copy_stream = torch.cuda.Stream(device=src.device)
+
+        # Copy on a side stream once the producing kernels have finished
+        self._copy_stream.wait_stream(torch.cuda.current_stream(src.device))
+        with torch.cuda.stream(self._copy_stream):
+            dst.copy_(src, non_blocking=True)
+        src.record_stream(self._copy_stream)  # keep alive until copied
+
+    def _write_slot(self, slabs, module_str, tensor, num_slots, slot_shape):
+        """Copies tensor into the current slot of module_str's slab in slabs.
+
+        The slab, of shape [num_slots, *slot_shape], is allocated on first
+        use (slot_shape defaults to tensor's shape). Smaller tensors, e.g.
+        cropped batches, fill the leading part of their slot. GPU tensors
+        are copied asynchronously; see synchronize_caches.
+        """
+        if module_str not in slabs:
+            slabs[module_str] = torch.zeros(
+                (num_slots, *(slot_shape or tensor.shape)),
+                dtype=tensor.dtype,
+                device='cpu',
+                pin_memory=tensor.is_cuda,
+                )
+
+        slot = slabs[module_str][self._slab_idx[module_str]]
+        slot = slot[tuple(slice(0, n) for n in tensor.shape)]  # short outputs
+        if slot.is_contiguous():
+            self._copy_to_host(slot, tensor)
+
+        else:
+            # Copies into strided host views block, so copy row by row. Each
+            # row's [L, ...] region is contiguous; this costs at most B (the
+            # batch size) copy launches per slab per forward pass.
+            for slot_row, row in zip(slot, tensor):
+                self._copy_to_host(slot_row, row)
+
+    def _build_caching_hook(
+            self,
+            module_str,
+            num_slots=None,
+            slot_shape=None,
+            quantize=False,
+            select_fn=None,
+            ):
+        if select_fn is None:
+            select_fn = lambda output: output.detach()
+
+        def capture(output):
+            """Returns the (activations, scales) to cache for output."""
+            acts = select_fn(output)
+            if quantize:
+                return quantize_rows(acts)
+
+            return acts, None
+
+        if num_slots is not None:
+            self._slab_idx[module_str] = 0
+            scales_shape = slot_shape[:-1] if slot_shape is not None else None
+            def hook_fn(model, input, output):
+                acts, scales = capture(output)
+                self._write_slot(
+                    self.activations_slab, module_str, acts, num_slots, slot_shape
+                    )
+                if scales is not None:
+                    self._write_slot(
+                        self.scales_slab, module_str, scales, num_slots, scales_shape
+                        )
+
+                idx = self._slab_idx[module_str]
+                self._slab_idx[module_str] = (idx + 1) % num_slots
+
+            return hook_fn
+
+        # Bind the lists themselves; clear_cache empties them in place.
+        # Tensors stay on the output's device, so they are ready to read as
+        # soon as the forward pass returns.
+        cache = self.activations_cache[module_str] = []
+        if quantize:
+            scales_cache = self.scales_cache[module_str] = []
         def hook_fn(model, input, output):
-            self.activations_cache[module_str].append(output)
+            acts, scales = capture(output)
+            cache.append(acts)
+            if scales is not None:
+                scales_cache.append(scales)
 
         return hook_fn
 
-    def add_caching_hook(self, module_str):
-        """Adds an activations caching hook at the location in module_str."""
-        hook_fn = self._build_caching_hook(module_str)
+    def add_caching_hook(
+            self,
+            module_str,
+            num_slots=None,
+            slot_shape=None,
+            quantize=False,
+            select_fn=None,
+            ):
+        """Adds an activations caching hook at the location in module_str.
+
+        Outputs are appended, on their own device, to activations_cache.
+        num_slots: write into a CPU ring buffer in activations_slab instead.
+        slot_shape: shape of each ring buffer slot; defaults to first output's.
+        quantize: store int8 rows, with scales in scales_cache/scales_slab.
+        select_fn: maps each output to the tensor to cache; defaults to detach.
+        """
+        hook_fn = self._build_caching_hook(
+            module_str,
+            num_slots=num_slots,
+            slot_shape=slot_shape,
+            quantize=quantize,
+            select_fn=select_fn,
+            )
         self.add_hook(hook_fn, module_str, 'cache-'+module_str)
 
+    def add_caching_wrapper(
+            self,
+            module_str,
+            num_slots=None,
+            slot_shape=None,
+            quantize=False,
+            select_fn=None,
+            ):
+        """Like add_caching_hook, but swaps the module for a CachingWrapper."""
+        hook_fn = self._build_caching_hook(
+            module_str,
+            num_slots=num_slots,
+            slot_shape=slot_shape,
+            quantize=quantize,
+            select_fn=select_fn,
+            )
+        parent_str, _, name = module_str.rpartition('-')
+        parent = self._module_dict[parent_str] if parent_str else self.model
+        module = self._module_dict[module_str]
+        setattr(parent, name, CachingWrapper(module, hook_fn))
+        self.hooks['cache-'+module_str] = _ModuleSwapHandle(parent, name, module)
+
+    def synchronize_caches(self):
+        """Blocks until pending copies into activations_slab/scales_slab finish.
+
+        Call this before reading a ring buffer filled from the GPU.
+        """
+        if self._copy_stream is not None:
+            self._copy_stream.synchronize()
+
     def clear_cache(self, module_str):
         """Clears the activations cache corresponding to module_str."""
-        if module_str not in self.activations_cache.keys():
+        if module_str in self._slab_idx:
+            self._slab_idx[module_str] = 0  # slab is overwritten in place
+
+        elif module_str not in self.activations_cache:
             raise KeyError(f'No activations cache for {module_str}.')
         
         else:
-            self.activations_cache[module_str] = []
+            self.activations_cache[module_str].clear()
+            if module_str in self.scales_cache:
+                self.scales_cache[module_str].clear()
 
     def clear_all_caches(self):
         """Clear all activation caches."""
-        for module_str in self.activations_cache.keys():
-            self.clear_cache(module_str)
+        for cache in self.activations_cache.values():
+            cache.clear()
+
+        for cache in self.scales_cache.values():
+            cache.clear()
+
+        for module_str in self._slab_idx:
+            self._slab_idx[module_str] = 0
 
     def remove_cache(self, module_str):
-        """Remove the cache for module_str."""
-        del self.activations_cache[module_str]
+        """Remove the cache for module_str, and its caching hook if attached."""
+        if 'cache-'+module_str in self.hooks:  # hook would keep filling it
+            self.remove_hook('cache-'+module_str)
+
+        if module_str in self._slab_idx:
+            del self._slab_idx[module_str]
+            self.activations_slab.pop(module_str, None)
+            self.scales_slab.pop(module_str, None)
+
+        else:
+            del self.activations_cache[module_str]
+            self.scales_cache.pop(module_str, None)
 
     def remove_all_caches(self):
         """Remove all caches."""
         caches = list(self.activations_cache.keys())
+        caches += list(self._slab_idx.keys())
         for cache_str in caches:
             self.remove_cache(cache_str)
 
     """Activation override"""
     def _build_override_hook(self, module_str):
         self.override_store[module_str] = None  # won't override when returned
+        override_store = self.override_store
         def hook_fn(model, input, output):
-            return self.override_store[module_str]
+            return override_store[module_str]
         
         return hook_fn
     
@@ -110,3 +273,29 @@ class LlamaScope:
         hooks = list(self.hooks.keys())
         for hook_name in hooks:
             self.remove_hook(hook_name)
+
+
+class CachingWrapper(torch.nn.Module):
+    """Calls a module and passes its output to capture_fn before returning."""
+
+    def __init__(self, module, capture_fn):
+        super().__init__()
+        self.module = module
+        self.capture_fn = capture_fn
+
+    def forward(self, *args, **kwargs):
+        output = self.module(*args, **kwargs)
+        self.capture_fn(self.module, args, output)  # same signature as a hook
+        return output
+
+
+class _ModuleSwapHandle:
+    """Hook-handle-like object that puts a swapped-out module back."""
+
+    def __init__(self, parent, name, module):
+        self.parent = parent
+        self.name = name
+        self.module = module
+
+    def remove(self):
+        setattr(self.parent, self.name, self.module)
@@ -0,0 +1,66 @@
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+
+def quantize_rows(x):
+    """Symmetric int8 quantisation with one scale per row (last dimension).
+
+    Returns (q, scale) with q an int8 tensor shaped like x and scale a
+    float32 tensor of shape x.shape[:-1], such that x ~= q * scale[..., None].
+    CUDA tensors are quantised in a single fused Triton kernel if Triton is
+    installed.
+    """
+    if triton is not None and x.is_cuda:
+        return _quantize_rows_triton(x)
+
+    return _quantize_rows_torch(x)
+
+
+def dequantize_rows(q, scale, dtype=torch.float32):
+    """Inverse of quantize_rows."""
+    return (q.float() * scale[..., None]).to(dtype)
+
+
+def _quantize_rows_torch(x):
+    x = x.float()
+    scale = x.abs().amax(dim=-1) / 127
+    scale = scale.clamp(min=torch.finfo(torch.float32).tiny)  # all-zero rows
+    q = torch.round(x / scale[..., None]).to(torch.int8)
+    return q, scale
+
+
+if triton is not None:
+    @triton.jit
+    def _quantize_rows_kernel(x_ptr, q_ptr, s_ptr, H, BLOCK: tl.constexpr):
+        """Quantises one row: a single read of x for both absmax and cast."""
+        row = tl.program_id(0)
+        cols = tl.arange(0, BLOCK)
+        mask = cols < H
+        x = tl.load(x_ptr + row * H + cols, mask=mask, other=0.0).to(tl.float32)
+
+        scale = tl.max(tl.abs(x), axis=0) / 127
+        scale = tl.maximum(scale, 1.1754943508222875e-38)  # all-zero rows
+        q = x / scale
+        q = q + tl.where(q >= 0, 0.5, -0.5)  # int cast truncates towards zero
+
+        tl.store(q_ptr + row * H + cols, q.to(tl.int8), mask=mask)
+        tl.store(s_ptr + row, scale)
+
+
+def _quantize_rows_triton(x):
+    x = x.contiguous()
+    H = x.shape[-1]
+    q = torch.empty(x.shape, dtype=torch.int8, device=x.device)
+    scale = torch.empty(x.shape[:-1], dtype=torch.float32, device=x.device)
+    num_rows = scale.numel()
+    if num_rows > 0:
+        _quantize_rows_kernel[(num_rows,)](
+            x, q, scale, H, BLOCK=triton.next_power_of_2(H)
+            )
+
+    return q, scale